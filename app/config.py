@@ -0,0 +1,71 @@
+"""
+Central configuration: loads .env once and owns the provider client
+singletons, so importing any service doesn't repeat dotenv parsing,
+directory creation, or client construction.
+"""
+import logging
+import os
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+from elevenlabs.client import AsyncElevenLabs
+from google import genai
+from google.genai import types
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+ELEVEN_LABS_API_KEY = os.getenv("ELEVEN_LABS_API_KEY")
+# Optional in-region endpoint (e.g. asia-south1) to cut network RTT
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+# Scratch space for audio files. Point TEMP_DIR at a tmpfs mount (e.g.
+# /dev/shm/agri-voice) to keep per-request audio entirely in memory -
+# every write here is transient, so skipping the disk round-trip is free.
+TEMP_DIR = Path(os.getenv("TEMP_DIR", "temp"))
+LOGS_DIR = Path("logs")
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
+LOGS_DIR.mkdir(exist_ok=True)
+
+if not GOOGLE_API_KEY:
+    logger.warning("GOOGLE_API_KEY not found in .env")
+if not ELEVEN_LABS_API_KEY:
+    logger.warning("ELEVEN_LABS_API_KEY not found in .env")
+
+# Gemini clients (timeouts in ms - audio uploads get more headroom, and a
+# hung call must not pin a task slot). The pool settings are handed to
+# the SDK's internal httpx.AsyncClient so burst traffic reuses warm
+# keep-alive connections instead of opening one TLS session per call.
+_GEMINI_POOL_ARGS = {
+    "limits": httpx.Limits(
+        max_connections=64, max_keepalive_connections=32, keepalive_expiry=300.0
+    ),
+}
+gemini_client = genai.Client(
+    api_key=GOOGLE_API_KEY,
+    http_options=types.HttpOptions(
+        base_url=GEMINI_API_ENDPOINT, timeout=30_000,
+        async_client_args=_GEMINI_POOL_ARGS,
+    ),
+)
+gemini_stt_client = genai.Client(
+    api_key=GOOGLE_API_KEY,
+    http_options=types.HttpOptions(
+        base_url=GEMINI_API_ENDPOINT, timeout=60_000,
+        async_client_args=_GEMINI_POOL_ARGS,
+    ),
+)
+
+# Persistent keep-alive HTTP client so repeated synthesis calls reuse the
+# TCP+TLS session instead of re-handshaking. Async client so audio chunks
+# are awaited instead of blocking the event loop.
+eleven_httpx_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=300.0),
+    timeout=httpx.Timeout(30.0),
+)
+eleven_client = AsyncElevenLabs(
+    api_key=ELEVEN_LABS_API_KEY, timeout=30.0, httpx_client=eleven_httpx_client
+)
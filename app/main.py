@@ -4,32 +4,77 @@ Gemini STT + Gemini LLM + ElevenLabs TTS
 """
 import logging
 import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from queue import Queue
+
+# The logs directory must exist before the handlers below open their
+# files; app.config creates it too, but that imports later
+Path("logs").mkdir(exist_ok=True)
+
+# Configure logging: handlers run on a QueueListener thread so log I/O
+# (file writes, stream flushes) never happens on the event loop
+_log_queue = Queue(-1)
+_formatter = logging.Formatter(
+    fmt='%(asctime)s | %(levelname)-8s | %(name)s | %(message)s',
+    datefmt='%H:%M:%S'
+)
+_file_handler = RotatingFileHandler(
+    "logs/bot.log", maxBytes=10_000_000, backupCount=5, encoding="utf-8"
+)
+_file_handler.setFormatter(_formatter)
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(_formatter)
+_log_listener = QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
 
-# Configure logging
+# The queue handler must not format: records are enqueued raw and the
+# listener-side handlers apply _formatter exactly once (basicConfig
+# would attach its default format here, double-formatting every line)
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s | %(levelname)-8s | %(name)s | %(message)s',
-    datefmt='%H:%M:%S',
-    handlers=[logging.StreamHandler(sys.stdout)],
+    handlers=[_queue_handler],
     force=True
 )
 
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import voice_v2, telegram
+from app.services import elevenlabs_tts, gemini_llm, gemini_stt
+from app.services.elevenlabs_tts import evict_stale_tts_cache
 import os
-from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
-# Create directories
-Path("temp").mkdir(exist_ok=True)
-Path("logs").mkdir(exist_ok=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm both provider connections while registering the webhook so the
+    # first user after a deploy doesn't eat the cold-start latency
+    await asyncio.gather(
+        telegram.register_webhook(),
+        gemini_llm.warmup(),
+        gemini_stt.warmup(),
+        elevenlabs_tts.warmup(),
+    )
+    tts_evictor = asyncio.create_task(evict_stale_tts_cache())
+    yield
+    tts_evictor.cancel()
+    # Close shared HTTP connection pools on shutdown
+    await telegram.close_telegram_clients()
+    _log_listener.stop()
+
 
 app = FastAPI(
     title="Kisan Voice Bot API",
     description="Multilingual agricultural voice assistant for Indian farmers (Cloud Processing)",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
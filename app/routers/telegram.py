@@ -1,62 +1,184 @@
 from fastapi import APIRouter, Request, BackgroundTasks
-import requests
+import aiofiles
+import asyncio
+import httpx
+import logging
+import orjson
 import os
-import sys
 import time
-from datetime import datetime
-from dotenv import load_dotenv
-
-load_dotenv()
+import websockets
+from collections import OrderedDict
+from pathlib import Path
+from uuid import uuid4
 
+# app.config loads .env once for the whole app; importing it before the
+# os.getenv reads below is what makes them see the file's values
+from app.config import TEMP_DIR
 from app.services.gemini_stt import transcribe_audio_gemini
-from app.services.gemini_llm import get_gemini_response, make_pronounceable_for_tts
-from app.services.elevenlabs_tts import text_to_speech_elevenlabs
+from app.services.gemini_llm import stream_gemini_sentences, make_pronounceable_for_tts
+from app.services.elevenlabs_tts import append_text_to_speech, stream_text_to_speech_ws
+from app.services.response_cache import get_cached_reply, cache_reply
 
 router = APIRouter()
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
 
-processed_updates = set()
+# Shared async HTTP clients - keep-alive pools so Telegram API calls
+# don't block the event loop while other users' pipelines are running,
+# and TCP+TLS handshakes are amortized across the 3-4 calls per message
+# Pool limits go on the transport: httpx ignores the client-level
+# limits kwarg when an explicit transport is passed
+TG_CLIENT = httpx.AsyncClient(
+    base_url=BASE_URL,
+    timeout=httpx.Timeout(connect=3, read=20, write=20, pool=2),
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+    ),
+)
+# Separate client for file downloads (file URLs use a different path scheme)
+TG_FILE_CLIENT = httpx.AsyncClient(
+    timeout=httpx.Timeout(connect=3, read=30, write=30, pool=2),
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+    ),
+)
 
-# Logs directory
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
 
+async def close_telegram_clients():
+    """Close shared HTTP clients (called from the app lifespan on shutdown)"""
+    await TG_CLIENT.aclose()
+    await TG_FILE_CLIENT.aclose()
 
-def log(message: str):
-    """Print to terminal (stderr for visibility) AND save to log file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted = f"[{timestamp}] {message}"
-    
-    # Print to STDERR (more reliable in uvicorn)
-    print(formatted, file=sys.stderr, flush=True)
-    sys.stderr.flush()
-    
-    # Also save to file
-    log_file = os.path.join(LOGS_DIR, f"bot_{datetime.now().strftime('%Y%m%d')}.log")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(formatted + "\n")
+
+async def register_webhook():
+    """Register the webhook at startup: more parallel connections, only
+    message updates (everything else is dropped by the handler anyway)"""
+    if not (BOT_TOKEN and WEBHOOK_URL):
+        return
+    payload = {
+        "url": WEBHOOK_URL,
+        "max_connections": 100,
+        "allowed_updates": ["message"],
+        "drop_pending_updates": True,
+    }
+    if WEBHOOK_SECRET:
+        payload["secret_token"] = WEBHOOK_SECRET
+    try:
+        result = (await TG_CLIENT.post("/setWebhook", json=payload)).json()
+        logger.info(f"setWebhook ok={result.get('ok')}")
+    except Exception as e:
+        logger.warning(f"setWebhook failed: {e}")
+
+logger = logging.getLogger(__name__)
+
+
+class TTLDedupe:
+    """Bounded dedupe for Telegram updates: LRU eviction + TTL expiry,
+    so memory stays O(max_entries) regardless of bot uptime"""
+
+    def __init__(self, max_entries: int = 2000, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def seen(self, key) -> bool:
+        """Record key; return True if it was already recorded recently"""
+        now = time.time()
+        # Expire oldest entries first (insertion order == age order)
+        while self._entries:
+            added = next(iter(self._entries.values()))
+            if now - added > self.ttl:
+                self._entries.popitem(last=False)
+            else:
+                break
+        if key in self._entries:
+            return True
+        self._entries[key] = now
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return False
+
+
+def _update_key(data: dict):
+    """Stable dedupe key: update_id, else callback id, else (chat, message)"""
+    if data.get("update_id") is not None:
+        return data["update_id"]
+    callback = data.get("callback_query")
+    if callback and callback.get("id"):
+        return f"cb:{callback['id']}"
+    message = data.get("message", {})
+    return (message.get("chat", {}).get("id"), message.get("message_id"))
+
+
+processed_updates = TTLDedupe()
+
+# Optional Redis-backed dedupe so multiple uvicorn workers don't
+# double-process Telegram retries; falls back to the in-process cache
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    try:
+        import redis.asyncio as redis
+        redis_client = redis.from_url(REDIS_URL)
+    except ImportError:
+        # The redis package is an optional extra; a configured REDIS_URL
+        # without it must degrade, not take the service down at boot
+        logger.warning(
+            "REDIS_URL is set but the redis package is not installed "
+            "(pip install .[redis]); falling back to per-process dedupe."
+        )
+if redis_client is None and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+    # Without Redis each worker keeps its own dedupe cache, so a
+    # Telegram re-delivery landing on a different worker gets processed
+    # (and billed) twice
+    logger.warning(
+        "WEB_CONCURRENCY > 1 without REDIS_URL: webhook dedupe is "
+        "per-process and re-deliveries may be double-processed. Set "
+        "REDIS_URL or run a single worker."
+    )
+
+
+async def _is_duplicate(update_key) -> bool:
+    """True if this update was already accepted by any worker"""
+    if redis_client is not None:
+        try:
+            accepted = await redis_client.set(
+                f"tg:upd:{update_key}", "1", nx=True, ex=300
+            )
+            return not accepted
+        except Exception as e:
+            logger.warning(f"Redis dedupe unavailable, using in-process: {e}")
+    return processed_updates.seen(update_key)
 
 
 @router.post("/telegram")
 async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        logger.warning("Webhook secret mismatch - dropping update")
+        return {"status": "forbidden"}
+
     try:
-        data = await request.json()
+        # orjson is several times faster than stdlib json for the nested
+        # Telegram Update payloads that arrive on every webhook
+        data = orjson.loads(await request.body())
     except Exception as e:
-        log(f"[ERROR] Failed to parse request: {e}")
+        logger.error(f"Failed to parse request: {e}")
         return {"status": "error"}
     
-    log(f"Telegram update: id={data.get('update_id')}")
+    logger.debug(f"Telegram update: id={data.get('update_id')}")
 
     if "message" not in data:
         return {"status": "ignored"}
 
-    update_id = data.get("update_id")
-    if update_id in processed_updates:
-        log(f"[WARN] Duplicate: {update_id}")
+    update_key = _update_key(data)
+    if await _is_duplicate(update_key):
+        logger.warning(f"Duplicate: {update_key}")
         return {"status": "duplicate"}
-    processed_updates.add(update_id)
 
     background_tasks.add_task(process_update_async, data)
     return {"status": "ok"}
@@ -65,8 +187,9 @@ async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
 async def process_update_async(data):
     """Process voice messages using Gemini for everything"""
     chat_id = None
+    local_audio = None
     total_start = time.time()
-    
+
     try:
         chat_id = data["message"]["chat"]["id"]
         user_info = data["message"].get("from", {})
@@ -74,27 +197,34 @@ async def process_update_async(data):
 
         # Text Message
         if "text" in data["message"]:
-            requests.post(f"{BASE_URL}/sendMessage", json={
+            await TG_CLIENT.post("/sendMessage", json={
                 "chat_id": chat_id,
                 "text": "Please send a voice message. I will reply in voice."
             })
-            log(f"Text from {user_name} - sent prompt")
+            logger.info(f"Text from {user_name} - sent prompt")
             return
 
         # Voice Message
         if "voice" in data["message"]:
             file_id = data["message"]["voice"]["file_id"]
             
-            log("=" * 70)
-            log(f"NEW VOICE MESSAGE from {user_name} (chat: {chat_id})")
-            log("=" * 70)
+            logger.info("=" * 70)
+            logger.info(f"NEW VOICE MESSAGE from {user_name} (chat: {chat_id})")
+            logger.info("=" * 70)
 
-            # Get file from Telegram
-            file_info = requests.get(f"{BASE_URL}/getFile?file_id={file_id}").json()
+            # Get file info and show "recording voice..." to the user concurrently
+            _, file_info_response = await asyncio.gather(
+                TG_CLIENT.post("/sendChatAction", json={
+                    "chat_id": chat_id,
+                    "action": "record_voice"
+                }),
+                TG_CLIENT.get("/getFile", params={"file_id": file_id}),
+            )
+            file_info = file_info_response.json()
 
             if not file_info.get("ok"):
-                log(f"[ERROR] Telegram getFile failed")
-                requests.post(f"{BASE_URL}/sendMessage", json={
+                logger.error("Telegram getFile failed")
+                await TG_CLIENT.post("/sendMessage", json={
                     "chat_id": chat_id,
                     "text": "Audio file process nahi ho paayi. Dubara bhejein."
                 })
@@ -105,106 +235,151 @@ async def process_update_async(data):
 
             # ========== STEP 1: DOWNLOAD ==========
             step1_start = time.time()
-            os.makedirs("temp", exist_ok=True)
-            local_audio = "temp/telegram_input.ogg"
-            log(f"[STEP 1/5] Downloading audio...")
-            with open(local_audio, "wb") as f:
-                f.write(requests.get(file_url).content)
+            # Unique path per request - concurrent webhooks must not
+            # clobber each other's audio before STT reads it
+            local_audio = str(TEMP_DIR / f"tg_in_{uuid4().hex}.ogg")
+            logger.info(f"[STEP 1/5] Downloading audio...")
+            # Stream to disk in 64 KB chunks - constant memory per request
+            # and network recv overlaps with the (async) disk write
+            async with TG_FILE_CLIENT.stream("GET", file_url) as audio_response:
+                async with aiofiles.open(local_audio, "wb") as f:
+                    async for chunk in audio_response.aiter_bytes(65536):
+                        await f.write(chunk)
             step1_time = time.time() - step1_start
-            log(f"           Done in {step1_time:.1f}s")
+            logger.info(f"           Done in {step1_time:.1f}s")
 
             # ========== STEP 2: GEMINI STT ==========
             step2_start = time.time()
-            log(f"[STEP 2/5] Transcribing with Gemini STT...")
+            logger.info(f"[STEP 2/5] Transcribing with Gemini STT...")
             result = await transcribe_audio_gemini(local_audio)
             user_text = result["text"]
             detected_lang = result.get("language", "hi")
             step2_time = time.time() - step2_start
             
-            log("-" * 70)
-            log(f"TRANSCRIPTION ({step2_time:.1f}s)")
-            log(f"  Language: {detected_lang}")
-            log(f"  Text: {user_text}")
-            log("-" * 70)
-
-            # ========== STEP 3: GEMINI RESPONSE ==========
-            step3_start = time.time()
-            log(f"[STEP 3/5] Getting Gemini response...")
-            try:
-                raw_response = await get_gemini_response(user_text, detected_lang)
-            except Exception as e:
-                error_msg = str(e)
-                log(f"[ERROR] Gemini failed: {error_msg}")
-                requests.post(f"{BASE_URL}/sendMessage", json={
-                    "chat_id": chat_id,
-                    "text": f"Sorry, {error_msg}"
-                })
-                return
-            step3_time = time.time() - step3_start
-            
-            log("-" * 70)
-            log(f"GEMINI RESPONSE ({step3_time:.1f}s)")
-            log(f"  {raw_response}")
-            log("-" * 70)
-
-            # ========== STEP 4: TTS PREPARATION ==========
-            step4_start = time.time()
-            log(f"[STEP 4/5] Preparing text for TTS...")
-            tts_ready_text = await make_pronounceable_for_tts(raw_response, detected_lang)
-            step4_time = time.time() - step4_start
-            
-            was_romanized = (tts_ready_text != raw_response)
-            
-            log("-" * 70)
-            log(f"TTS PREP ({step4_time:.1f}s)")
-            log(f"  Romanized: {'YES' if was_romanized else 'NO'}")
-            log(f"  Text: {tts_ready_text}")
-            log("-" * 70)
-
-            # ========== STEP 5: AUDIO GENERATION ==========
-            step5_start = time.time()
-            log(f"[STEP 5/5] Generating audio with ElevenLabs...")
-            output_audio = await text_to_speech_elevenlabs(tts_ready_text)
-            step5_time = time.time() - step5_start
-            log(f"           Done in {step5_time:.1f}s")
+            logger.info("-" * 70)
+            logger.info(f"TRANSCRIPTION ({step2_time:.1f}s)")
+            logger.info(f"  Language: {detected_lang}")
+            logger.info(f"  Text: {user_text}")
+            logger.info("-" * 70)
+
+            # ========== STEP 3-5: CASCADED LLM -> TTS STREAMING ==========
+            cascade_start = time.time()
+
+            # Repeat query? Reuse the cached answer and voice note
+            cached = get_cached_reply(user_text, detected_lang)
+            if cached is not None:
+                logger.info("[STEP 3-5/5] Reply cache HIT - skipping LLM + TTS")
+                raw_response = cached["response"]
+                output_audio = cached["audio_path"]
+                cascade_time = time.time() - cascade_start
+            else:
+                # Each finished Gemini sentence is TTS-prepped and synthesized
+                # while the rest of the answer is still being generated, so
+                # time-to-audio tracks the first sentence, not the full reply
+                logger.info(f"[STEP 3-5/5] Streaming Gemini response into TTS...")
+                output_audio = str(TEMP_DIR / f"tg_reply_{time.time_ns():x}.mp3")
+
+                sentences = []
+                stream_finished = False
+
+                async def _romanized_sentences():
+                    nonlocal stream_finished
+                    async for sentence in stream_gemini_sentences(user_text, detected_lang):
+                        sentences.append(sentence)
+                        logger.info(f"  Sentence {len(sentences)}: {sentence}")
+                        yield await make_pronounceable_for_tts(sentence, detected_lang)
+                    stream_finished = True
+
+                try:
+                    sentence_gen = _romanized_sentences()
+                    try:
+                        # One WebSocket generation fed sentence by sentence -
+                        # synthesis overlaps the rest of the LLM stream
+                        await stream_text_to_speech_ws(sentence_gen, output_audio)
+                    except (websockets.WebSocketException, OSError) as ws_error:
+                        # Transport-level TTS failure only - anything the
+                        # Gemini stream raises propagates unchanged
+                        logger.warning(f"WS TTS failed ({ws_error}), falling back to per-sentence REST")
+                        Path(output_audio).unlink(missing_ok=True)
+                        # Re-synthesize what was already collected (the
+                        # romanization cache makes this cheap), then drain
+                        # the rest of the Gemini stream so the answer is
+                        # never truncated
+                        for sentence in list(sentences):
+                            tts_sentence = await make_pronounceable_for_tts(sentence, detected_lang)
+                            await append_text_to_speech(tts_sentence, output_audio)
+                        async for tts_sentence in sentence_gen:
+                            await append_text_to_speech(tts_sentence, output_audio)
+                    if not sentences:
+                        raise Exception("Empty response from Gemini")
+                except Exception as e:
+                    error_msg = str(e)
+                    logger.error(f"LLM/TTS cascade failed: {error_msg}")
+                    await TG_CLIENT.post("/sendMessage", json={
+                        "chat_id": chat_id,
+                        "text": f"Sorry, {error_msg}"
+                    })
+                    return
+
+                raw_response = " ".join(sentences)
+                cascade_time = time.time() - cascade_start
+                # Only a complete answer is worth caching (or delivering
+                # as if complete)
+                if stream_finished:
+                    cache_reply(user_text, detected_lang, raw_response, "", output_audio)
+
+                logger.info("-" * 70)
+                logger.info(f"GEMINI RESPONSE ({cascade_time:.1f}s, {len(sentences)} sentences)")
+                logger.info(f"  {raw_response}")
+                logger.info("-" * 70)
+
+            # Deliver the answer as text too, before the voice upload
+            await TG_CLIENT.post("/sendMessage", json={
+                "chat_id": chat_id,
+                "text": raw_response
+            })
 
             # Send voice back
-            log(f"Sending voice to Telegram...")
+            logger.info(f"Sending voice to Telegram...")
             send_start = time.time()
-            with open(output_audio, "rb") as audio:
-                response = requests.post(
-                    f"{BASE_URL}/sendVoice",
-                    data={"chat_id": chat_id},
-                    files={"voice": audio}
-                )
+            async with aiofiles.open(output_audio, "rb") as audio:
+                voice_bytes = await audio.read()
+            response = await TG_CLIENT.post(
+                "/sendVoice",
+                data={"chat_id": chat_id},
+                files={"voice": voice_bytes}
+            )
             send_time = time.time() - send_start
             
             total_time = time.time() - total_start
             
             if response.status_code == 200:
-                log(f"[SUCCESS] Voice sent to {user_name}")
+                logger.info(f"[SUCCESS] Voice sent to {user_name}")
             else:
-                log(f"[ERROR] Send failed: {response.status_code}")
+                logger.error(f"Send failed: {response.status_code}")
             
-            log("=" * 70)
-            log(f"COMPLETED in {total_time:.1f}s total")
-            log(f"  Step 1 (Download):      {step1_time:.1f}s")
-            log(f"  Step 2 (Gemini STT):    {step2_time:.1f}s")
-            log(f"  Step 3 (Gemini LLM):    {step3_time:.1f}s")
-            log(f"  Step 4 (TTS Prep):      {step4_time:.1f}s")
-            log(f"  Step 5 (ElevenLabs):    {step5_time:.1f}s")
-            log(f"  Send to Telegram:       {send_time:.1f}s")
-            log("=" * 70)
+            logger.info("=" * 70)
+            logger.info(f"COMPLETED in {total_time:.1f}s total")
+            logger.info(f"  Step 1 (Download):      {step1_time:.1f}s")
+            logger.info(f"  Step 2 (Gemini STT):    {step2_time:.1f}s")
+            logger.info(f"  Step 3-5 (LLM+TTS):     {cascade_time:.1f}s")
+            logger.info(f"  Send to Telegram:       {send_time:.1f}s")
+            logger.info("=" * 70)
 
     except Exception as e:
         import traceback
-        log(f"[ERROR] {e}")
-        log(traceback.format_exc())
+        logger.error(f"{e}")
+        logger.error(traceback.format_exc())
         try:
             if chat_id:
-                requests.post(f"{BASE_URL}/sendMessage", json={
+                await TG_CLIENT.post("/sendMessage", json={
                     "chat_id": chat_id,
                     "text": f"Sorry, error: {str(e)}"
                 })
         except:
             pass
+    finally:
+        # Remove the downloaded audio; the preprocessed STT copy is
+        # content-addressed and left for the hourly cache sweep
+        if local_audio:
+            Path(local_audio).unlink(missing_ok=True)
@@ -1,32 +1,31 @@
 from fastapi import APIRouter, File, UploadFile, Form, HTTPException
 from fastapi.responses import FileResponse, JSONResponse
-import shutil
-import sys
+from starlette.background import BackgroundTask
+import aiofiles
+import logging
 import time
 from pathlib import Path
-from datetime import datetime
 from urllib.parse import quote
-import os
 
+from app.config import TEMP_DIR
 from app.services.gemini_stt import transcribe_audio_gemini
-from app.services.gemini_llm import get_gemini_response, make_pronounceable_for_tts
+from app.services.gemini_llm import (
+    get_gemini_response,
+    get_gemini_response_with_tts,
+    make_pronounceable_for_tts,
+)
 from app.services.elevenlabs_tts import text_to_speech_elevenlabs
+from app.services.response_cache import get_cached_reply, cache_reply
 
 router = APIRouter()
 
-TEMP_DIR = Path("temp")
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
+logger = logging.getLogger(__name__)
 
-def log(message: str):
-    """Print to terminal AND save to log file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted = f"[{timestamp}] {message}"
-    print(formatted, file=sys.stderr, flush=True)
-    sys.stderr.flush()
-    log_file = os.path.join(LOGS_DIR, f"bot_{datetime.now().strftime('%Y%m%d')}.log")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(formatted + "\n")
+
+def _cleanup_files(*paths: Path):
+    """Delete temp files after the response has been sent"""
+    for path in paths:
+        path.unlink(missing_ok=True)
 
 
 @router.post("/process-voice")
@@ -36,85 +35,98 @@ async def process_voice_v2(
     '''
     V2 Pipeline - Uses Gemini for EVERYTHING:
     - Gemini STT: Audio transcription (replaces Whisper)
-    - Gemini Instance 1: Agricultural advice
-    - Gemini Instance 2: TTS optimization (romanization)
+    - Gemini combined call: Agricultural advice + TTS optimization
     - ElevenLabs: Text-to-speech
     '''
     input_path = None
     total_start = time.time()
     
     try:
-        # Generate unique filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        input_path = TEMP_DIR / f"v2_input_{timestamp}_{audio.filename}"
+        # Unique filename: monotonic ns avoids strftime allocations and
+        # never collides for concurrent uploads, unlike second precision
+        tag = f"{time.monotonic_ns():x}"
+        input_path = TEMP_DIR / f"v2_input_{tag}_{audio.filename}"
         
-        # Save uploaded audio
-        with input_path.open("wb") as buffer:
-            shutil.copyfileobj(audio.file, buffer)
+        # Save uploaded audio in chunks without blocking the event loop
+        async with aiofiles.open(input_path, "wb") as buffer:
+            while chunk := await audio.read(65536):
+                await buffer.write(chunk)
         
-        log("=" * 70)
-        log(f"V2 VOICE PROCESSING - {audio.filename}")
-        log("=" * 70)
+        logger.info("=" * 70)
+        logger.info(f"V2 VOICE PROCESSING - {audio.filename}")
+        logger.info("=" * 70)
         
         # Step 1: Gemini STT (replaces Whisper)
         step1_start = time.time()
-        log(f"[STEP 1/4] Transcribing with Gemini STT...")
+        logger.info(f"[STEP 1/3] Transcribing with Gemini STT...")
         transcription_result = await transcribe_audio_gemini(str(input_path))
         transcription = transcription_result["text"]
         detected_language = transcription_result.get("language", "hi")
         step1_time = time.time() - step1_start
         
-        log("-" * 70)
-        log(f"TRANSCRIPTION ({step1_time:.1f}s)")
-        log(f"  Language: {detected_language}")
-        log(f"  Text: {transcription}")
-        log("-" * 70)
-        
-        # Step 2: Gemini Agricultural Advisor
+        logger.info("-" * 70)
+        logger.info(f"TRANSCRIPTION ({step1_time:.1f}s)")
+        logger.info(f"  Language: {detected_language}")
+        logger.info(f"  Text: {transcription}")
+        logger.info("-" * 70)
+        
+        # Repeat query? Skip LLM + TTS and return the cached MP3
+        cached = get_cached_reply(transcription, detected_language)
+        if cached is not None:
+            logger.info("Reply cache HIT - returning cached MP3")
+            return FileResponse(
+                cached["audio_path"],
+                media_type="audio/mpeg",
+                headers={
+                    "X-Transcription": quote(transcription[:200], safe=''),
+                    "X-Raw-Response": quote(cached["response"][:200], safe=''),
+                    "X-TTS-Text": quote(cached["tts_text"][:200], safe=''),
+                    "X-Language": detected_language,
+                    "X-Cache": "HIT"
+                },
+                filename=f"v2_response_{tag}.mp3",
+                background=BackgroundTask(_cleanup_files, input_path)
+            )
+
+        # Step 2: Gemini Advisor + TTS prep (one combined structured call)
         step2_start = time.time()
-        log(f"[STEP 2/4] Getting Gemini response...")
-        raw_response = await get_gemini_response(transcription, detected_language)
+        logger.info(f"[STEP 2/3] Getting Gemini response (advisor + TTS prep)...")
+        raw_response, tts_ready_text = await get_gemini_response_with_tts(
+            transcription, detected_language
+        )
         step2_time = time.time() - step2_start
-        
-        log("-" * 70)
-        log(f"GEMINI RESPONSE ({step2_time:.1f}s)")
-        log(f"  {raw_response}")
-        log("-" * 70)
-        
-        # Step 3: Gemini TTS Optimizer
-        step3_start = time.time()
-        log(f"[STEP 3/4] Optimizing for TTS...")
-        tts_ready_text = await make_pronounceable_for_tts(raw_response, detected_language)
-        step3_time = time.time() - step3_start
-        
+
         was_romanized = (tts_ready_text != raw_response)
-        log("-" * 70)
-        log(f"TTS PREP ({step3_time:.1f}s)")
-        log(f"  Romanized: {'YES' if was_romanized else 'NO'}")
-        log(f"  Text: {tts_ready_text}")
-        log("-" * 70)
-        
-        # Step 4: ElevenLabs TTS
-        step4_start = time.time()
-        log(f"[STEP 4/4] Generating speech with ElevenLabs...")
+        logger.info("-" * 70)
+        logger.info(f"GEMINI RESPONSE ({step2_time:.1f}s)")
+        logger.info(f"  {raw_response}")
+        logger.info(f"  Romanized: {'YES' if was_romanized else 'NO'}")
+        logger.info(f"  TTS text: {tts_ready_text}")
+        logger.info("-" * 70)
+
+        # Step 3: ElevenLabs TTS
+        step3_start = time.time()
+        logger.info(f"[STEP 3/3] Generating speech with ElevenLabs...")
         output_audio_path = await text_to_speech_elevenlabs(tts_ready_text)
-        step4_time = time.time() - step4_start
-        log(f"           Done in {step4_time:.1f}s")
-        
-        # Cleanup input file
-        input_path.unlink()
-        
+        step3_time = time.time() - step3_start
+        logger.info(f"           Done in {step3_time:.1f}s")
+
         total_time = time.time() - total_start
-        
-        log("=" * 70)
-        log(f"V2 COMPLETED in {total_time:.1f}s")
-        log(f"  Step 1 (Gemini STT):    {step1_time:.1f}s")
-        log(f"  Step 2 (Gemini LLM):    {step2_time:.1f}s")
-        log(f"  Step 3 (TTS Prep):      {step3_time:.1f}s")
-        log(f"  Step 4 (ElevenLabs):    {step4_time:.1f}s")
-        log("=" * 70)
-        
-        # Return audio file with metadata
+
+        logger.info("=" * 70)
+        logger.info(f"V2 COMPLETED in {total_time:.1f}s")
+        logger.info(f"  Step 1 (Gemini STT):       {step1_time:.1f}s")
+        logger.info(f"  Step 2 (LLM + TTS prep):   {step2_time:.1f}s")
+        logger.info(f"  Step 3 (ElevenLabs):       {step3_time:.1f}s")
+        logger.info("=" * 70)
+        
+        cache_reply(transcription, detected_language, raw_response,
+                    tts_ready_text, output_audio_path)
+
+        # Return audio file with metadata; the uploaded file is deleted
+        # after the response is flushed, while the generated MP3 stays
+        # on disk for the reply cache
+        cleanup = BackgroundTask(_cleanup_files, input_path)
         return FileResponse(
             output_audio_path,
             media_type="audio/mpeg",
@@ -124,14 +136,15 @@ async def process_voice_v2(
                 "X-TTS-Text": quote(tts_ready_text[:200], safe=''),
                 "X-Language": detected_language
             },
-            filename=f"v2_response_{timestamp}.mp3"
+            filename=f"v2_response_{tag}.mp3",
+            background=cleanup
         )
         
     except Exception as e:
         # Cleanup on error
         if input_path and input_path.exists():
             input_path.unlink()
-        log(f"[ERROR] V2 pipeline: {e}")
+        logger.error(f"V2 pipeline: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -158,9 +171,9 @@ async def test_elevenlabs(
 ):
     '''Test endpoint for Eleven Labs TTS with pronunciation optimization'''
     try:
-        log(f"[Test] Optimizing text for TTS: {text}")
+        logger.info(f"[Test] Optimizing text for TTS: {text}")
         tts_ready_text = await make_pronounceable_for_tts(text)
-        log(f"[Test] Optimized result: {tts_ready_text}")
+        logger.info(f"[Test] Optimized result: {tts_ready_text}")
         
         output_path = await text_to_speech_elevenlabs(tts_ready_text)
         return FileResponse(
@@ -183,12 +196,12 @@ async def test_gemini_stt(
     '''Test endpoint for Gemini STT only'''
     input_path = None
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        input_path = TEMP_DIR / f"stt_test_{timestamp}_{audio.filename}"
-        
-        with input_path.open("wb") as buffer:
-            shutil.copyfileobj(audio.file, buffer)
+        input_path = TEMP_DIR / f"stt_test_{time.monotonic_ns():x}_{audio.filename}"
         
+        async with aiofiles.open(input_path, "wb") as buffer:
+            while chunk := await audio.read(65536):
+                await buffer.write(chunk)
+
         start = time.time()
         result = await transcribe_audio_gemini(str(input_path))
         elapsed = time.time() - start
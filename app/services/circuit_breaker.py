@@ -0,0 +1,43 @@
+"""
+Minimal in-process circuit breaker for the external AI providers.
+When a provider keeps failing, calls fail fast instead of queueing
+retries that pin task slots (and Telegram re-deliveries) for 30+ s.
+"""
+import time
+
+
+class CircuitBreaker:
+    """Opens after fail_max consecutive failures; after reset_timeout
+    seconds a single probe call is allowed through again."""
+
+    def __init__(self, name: str, fail_max: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def open(self) -> bool:
+        if self._failures < self.fail_max:
+            return False
+        if time.time() - self._opened_at > self.reset_timeout:
+            # Half-open: let the next call probe the provider
+            self._failures = self.fail_max - 1
+            return False
+        return True
+
+    def record_success(self):
+        self._failures = 0
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self.fail_max:
+            self._opened_at = time.time()
+
+    def check(self):
+        """Raise immediately if the breaker is open"""
+        if self.open:
+            raise Exception(
+                f"{self.name} is failing repeatedly - skipping call, try again shortly"
+            )
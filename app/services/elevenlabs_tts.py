@@ -1,63 +1,268 @@
+import aiofiles
+import asyncio
+import base64
+import hashlib
+import logging
+import orjson
 import os
-import sys
+import re
 import time
-from datetime import datetime
-from dotenv import load_dotenv
-from elevenlabs.client import ElevenLabs
+import websockets
 from pathlib import Path
 
-load_dotenv()
+from app.config import (
+    ELEVEN_LABS_API_KEY,
+    TEMP_DIR,
+    eleven_client as client,
+    eleven_httpx_client as _httpx_client,
+)
+from app.services.circuit_breaker import CircuitBreaker
 
-ELEVEN_LABS_API_KEY = os.getenv("ELEVEN_LABS_API_KEY")
-TEMP_DIR = Path("temp")
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
+logger = logging.getLogger(__name__)
 
-def log(message: str):
-    """Print to terminal AND save to log file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted = f"[{timestamp}] {message}"
-    print(formatted, file=sys.stderr, flush=True)
-    sys.stderr.flush()
-    log_file = os.path.join(LOGS_DIR, f"bot_{datetime.now().strftime('%Y%m%d')}.log")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(formatted + "\n")
+DEFAULT_VOICE_ID = "JBFqnCBsd6RMkjVDRZzb"  # Rachel
+# Resolved once at import - the env can't change under a running worker,
+# so there's no reason to consult os.environ on every synthesis call
+VOICE_ID = os.getenv("ELEVEN_LABS_INDIAN_VOICE_ID", DEFAULT_VOICE_ID)
+# Flash v2.5: ~75 ms model latency and half the per-char cost of
+# multilingual v2, still covers all our Indian languages
+MODEL_ID = "eleven_flash_v2_5"
+OUTPUT_FORMAT = "mp3_22050_32"
 
-if not ELEVEN_LABS_API_KEY:
-    log("[WARNING] ELEVEN_LABS_API_KEY not found in .env")
+TTS_BREAKER = CircuitBreaker("ElevenLabs")
+
+# ElevenLabs rejects requests over its per-call character cap with a 400
+# - catch both that and empty text locally before burning a round-trip
+# (and credits)
+MAX_TTS_CHARS = 40_000
+
+
+def _validate_text(text: str):
+    if not text or not text.strip():
+        raise Exception("ElevenLabs Error: empty text, nothing to synthesize")
+    if len(text) > MAX_TTS_CHARS:
+        raise Exception(
+            f"ElevenLabs Error: text too long ({len(text)} chars, cap {MAX_TTS_CHARS})"
+        )
+
+
+# Content-addressed disk cache: identical (voice, model, text) requests
+# reuse the MP3 already on disk instead of re-synthesizing (and re-billing)
+TTS_CACHE_MAX_AGE = 24 * 3600
+
+
+def _tts_cache_path(voice_id: str, text: str) -> Path:
+    key = hashlib.blake2b(
+        f"{voice_id}|{MODEL_ID}|{text}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+    return TEMP_DIR / f"tts_{key}.mp3"
+
+
+async def evict_stale_tts_cache():
+    """Hourly sweep deleting content-addressed cache files (synthesized
+    MP3s, preprocessed STT audio) and streamed Telegram replies older
+    than 24 h; started from the app lifespan"""
+    while True:
+        try:
+            cutoff = time.time() - TTS_CACHE_MAX_AGE
+            for pattern in ("tts_*.mp3*", "stt_pre_*.ogg*", "tg_reply_*.mp3*"):
+                for path in TEMP_DIR.glob(pattern):
+                    if path.stat().st_mtime < cutoff:
+                        path.unlink(missing_ok=True)
+        except Exception as e:
+            logger.warning(f"TTS cache eviction: {e}")
+        await asyncio.sleep(3600)
+
+
+async def warmup():
+    """Open (and keep alive) a connection to ElevenLabs at startup so the
+    first synthesis skips the TLS handshake. Failures are non-fatal."""
+    try:
+        await _httpx_client.get(
+            "https://api.elevenlabs.io/v1/voices",
+            headers={"xi-api-key": ELEVEN_LABS_API_KEY or ""},
+        )
+        logger.info("ElevenLabs warmup complete")
+    except Exception as e:
+        logger.warning(f"ElevenLabs warmup failed (non-fatal): {e}")
+
+
+WS_URL_TEMPLATE = (
+    "wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input"
+    f"?model_id={MODEL_ID}&output_format={OUTPUT_FORMAT}"
+)
+
+
+async def stream_text_to_speech_ws(text_iter, output_path) -> None:
+    """Feed streamed text (an async iterator of sentences/tokens) into
+    ElevenLabs' input-streaming WebSocket. Synthesis starts while the LLM
+    is still generating; audio frames are appended to output_path as they
+    arrive."""
+    start_time = time.time()
+    TTS_BREAKER.check()
+
+    url = WS_URL_TEMPLATE.format(voice_id=VOICE_ID)
+
+    try:
+        async with websockets.connect(
+            url, additional_headers={"xi-api-key": ELEVEN_LABS_API_KEY}
+        ) as ws:
+            # Init frame: voice settings + chunk scheduling. Frames are
+            # serialized with orjson and decoded to str - the ElevenLabs
+            # endpoint expects text frames, not binary
+            await ws.send(orjson.dumps({
+                "text": " ",
+                "voice_settings": {"stability": 0.5, "similarity_boost": 0.8},
+                "generation_config": {"chunk_length_schedule": [50, 120, 160, 250]},
+            }).decode())
+
+            async def _recv_audio():
+                async with aiofiles.open(output_path, "ab") as f:
+                    async for frame in ws:
+                        msg = orjson.loads(frame)
+                        if msg.get("audio"):
+                            await f.write(base64.b64decode(msg["audio"]))
+                        if msg.get("isFinal"):
+                            break
+
+            recv_task = asyncio.create_task(_recv_audio())
+            try:
+                async for piece in text_iter:
+                    await ws.send(orjson.dumps({"text": piece + " "}).decode())
+                await ws.send('{"text": ""}')  # flush and end generation
+                await recv_task
+            finally:
+                # A failure in the send loop (or inside text_iter) must
+                # not leave the receiver task dangling
+                if not recv_task.done():
+                    recv_task.cancel()
+                    try:
+                        await recv_task
+                    except (asyncio.CancelledError, Exception):
+                        pass
+
+        elapsed = time.time() - start_time
+        logger.info(f"ElevenLabs WS: Stream synthesized in {elapsed:.1f}s")
+        TTS_BREAKER.record_success()
+
+    except Exception as e:
+        elapsed = time.time() - start_time
+        logger.error(f"ElevenLabs WS ({elapsed:.1f}s): {e}")
+        TTS_BREAKER.record_failure()
+        raise
+
+
+def _stream_tts(text: str, voice_id: str):
+    """Open a streaming synthesis request; chunks arrive as generated
+    instead of after the full render. Returns an async iterator."""
+    return client.text_to_speech.stream(
+        text=text,
+        voice_id=voice_id,
+        model_id=MODEL_ID,
+        optimize_streaming_latency=3,
+        output_format=OUTPUT_FORMAT,
+    )
+
+
+# Sentence boundaries (includes Devanagari danda) for parallel synthesis
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[।.?!])\s+')
+# ElevenLabs allows 3 concurrent requests on the default plan
+_TTS_CONCURRENCY = asyncio.Semaphore(3)
+
+
+async def _synth_to_bytes(text: str, voice_id: str) -> bytes:
+    """Synthesize one sentence fully into memory, bounded by the
+    provider's concurrency limit"""
+    async with _TTS_CONCURRENCY:
+        chunks = []
+        async for chunk in _stream_tts(text, voice_id):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+
+async def append_text_to_speech(text: str, output_path) -> None:
+    """Synthesize one sentence and append its audio to output_path.
+    MP3 frame streams concatenate byte-wise, so cascaded pipelines can
+    build one voice note sentence by sentence."""
+    start_time = time.time()
+    _validate_text(text)
+    TTS_BREAKER.check()
+
+    try:
+        audio_generator = _stream_tts(text, VOICE_ID)
+
+        async with aiofiles.open(output_path, "ab") as f:
+            async for chunk in audio_generator:
+                await f.write(chunk)
+
+        elapsed = time.time() - start_time
+        logger.info(f"ElevenLabs: Sentence appended ({len(text)} chars, {elapsed:.1f}s)")
+        TTS_BREAKER.record_success()
+
+    except Exception as e:
+        elapsed = time.time() - start_time
+        logger.error(f"ElevenLabs ({elapsed:.1f}s): {e}")
+        TTS_BREAKER.record_failure()
+        raise Exception(f"ElevenLabs Error: {str(e)}")
 
-client = ElevenLabs(api_key=ELEVEN_LABS_API_KEY)
 
 async def text_to_speech_elevenlabs(text: str) -> str:
     """Convert text to speech using ElevenLabs"""
     start_time = time.time()
-    
+    _validate_text(text)
+    TTS_BREAKER.check()
+
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        output_path = TEMP_DIR / f"eleven_{timestamp}.mp3"
-        
-        default_voice_id = "JBFqnCBsd6RMkjVDRZzb"  # Rachel
-        indian_voice_id = os.getenv("ELEVEN_LABS_INDIAN_VOICE_ID", default_voice_id)
-        
-        log(f"           ElevenLabs: Generating ({len(text)} chars)...")
-        
-        audio_generator = client.text_to_speech.convert(
-            text=text,
-            voice_id=indian_voice_id, 
-            model_id="eleven_multilingual_v2"
-        )
-        
-        with open(output_path, "wb") as f:
-            for chunk in audio_generator:
-                f.write(chunk)
-        
+        output_path = _tts_cache_path(VOICE_ID, text)
+        out = str(output_path)
+
+        # One stat covers both the existence and the non-empty check
+        try:
+            cached_size = os.stat(out).st_size
+        except FileNotFoundError:
+            cached_size = 0
+        if cached_size > 0:
+            logger.info(f"ElevenLabs: Cache hit ({len(text)} chars)")
+            TTS_BREAKER.record_success()
+            return out
+
+        logger.info(f"ElevenLabs: Generating ({len(text)} chars)...")
+
+        # Write to a temp name, then rename: concurrent readers never see
+        # a half-written cache entry
+        tmp_path = output_path.with_suffix(".mp3.tmp")
+
+        sentences = [s for s in _SENTENCE_SPLIT_RE.split(text) if s.strip()]
+        if len(sentences) > 1:
+            # Multi-sentence answers: synthesize sentences concurrently
+            # (up to 3 in flight) and concatenate in order - MP3 frame
+            # streams join byte-wise without re-encoding
+            parts = await asyncio.gather(
+                *(_synth_to_bytes(s, VOICE_ID) for s in sentences)
+            )
+            async with aiofiles.open(tmp_path, "wb") as f:
+                for part in parts:
+                    await f.write(part)
+        else:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in _stream_tts(text, VOICE_ID):
+                    await f.write(chunk)
+        os.replace(tmp_path, output_path)
+
         elapsed = time.time() - start_time
-        file_size = output_path.stat().st_size
-        log(f"           ElevenLabs: Done ({file_size} bytes, {elapsed:.1f}s)")
-                
-        return str(output_path)
+        try:
+            file_size = os.stat(out).st_size
+        except FileNotFoundError:
+            raise Exception("synthesis produced no file")
+        if file_size == 0:
+            raise Exception("synthesis produced an empty file")
+        logger.info(f"ElevenLabs: Done ({file_size} bytes, {elapsed:.1f}s)")
+
+        TTS_BREAKER.record_success()
+        return out
 
     except Exception as e:
         elapsed = time.time() - start_time
-        log(f"[ERROR] ElevenLabs ({elapsed:.1f}s): {e}")
+        logger.error(f"ElevenLabs ({elapsed:.1f}s): {e}")
+        TTS_BREAKER.record_failure()
         raise Exception(f"ElevenLabs Error: {str(e)}")
@@ -1,40 +1,36 @@
-from google import genai
 from google.genai import types
-import os
-import sys
+import hashlib
+import logging
+import orjson
+import random
+import re
 import asyncio
 import time
-from datetime import datetime
-from dotenv import load_dotenv
+from typing import AsyncIterator
+from collections import OrderedDict
+from functools import lru_cache
 
-load_dotenv()
+from app.config import gemini_client as client
+from app.services.circuit_breaker import CircuitBreaker
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Local transliteration is deterministic and table-driven - when the
+# package is available it replaces a whole Gemini round-trip
+try:
+    from indic_transliteration import sanscript
+except ImportError:
+    sanscript = None
 
-# Logging setup
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
+logger = logging.getLogger(__name__)
 
-def log(message: str):
-    """Print to terminal AND save to log file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted = f"[{timestamp}] {message}"
-    print(formatted, flush=True)
-    sys.stdout.flush()
-    sys.stderr.flush()
-    log_file = os.path.join(LOGS_DIR, f"bot_{datetime.now().strftime('%Y%m%d')}.log")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(formatted + "\n")
-
-if not GOOGLE_API_KEY:
-    log("[WARNING] GOOGLE_API_KEY not found in .env")
-
-# Create Gemini client
-client = genai.Client(api_key=GOOGLE_API_KEY)
 MODEL_NAME = "gemini-2.5-flash"
 
-# Retry delays in seconds
-RETRY_DELAYS = [5, 10, 15]
+GEMINI_BREAKER = CircuitBreaker("Gemini")
+
+# Decorrelated-jitter backoff: spreads concurrent retries out instead of
+# having every stalled user hammer the API again on the same schedule
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10.0
 
 # Language mapping
 LANGUAGE_NAMES = {
@@ -48,20 +44,76 @@ LANGUAGE_NAMES = {
 DEVANAGARI_SCRIPT_LANGS = {"hi", "mr", "ne", "bh", "mai", "raj", "ks", "sd"}
 NEEDS_ROMANIZATION_LANGS = {"ta", "te", "kn", "ml", "bn", "gu", "pa", "or", "as"}
 
+# indic_transliteration scheme per language (Assamese shares the Bengali
+# script)
+_TRANSLIT_SCHEMES = {
+    "ta": "tamil", "te": "telugu", "kn": "kannada", "ml": "malayalam",
+    "bn": "bengali", "gu": "gujarati", "pa": "gurmukhi", "or": "oriya",
+    "as": "bengali",
+}
+
+# Romanization cache: repeated phrasings (greetings, canned replies)
+# skip the TTS-prep Gemini round-trip entirely
+_TTS_CACHE_MAX = 1024
+_TTS_CACHE_TTL = 3600
+_tts_cache = OrderedDict()
+
+
+def _tts_cache_get(key):
+    entry = _tts_cache.get(key)
+    if entry is None:
+        return None
+    result, added = entry
+    if time.time() - added > _TTS_CACHE_TTL:
+        del _tts_cache[key]
+        return None
+    _tts_cache.move_to_end(key)
+    return result
+
+
+def _tts_cache_put(key, result):
+    _tts_cache[key] = (result, time.time())
+    _tts_cache.move_to_end(key)
+    while len(_tts_cache) > _TTS_CACHE_MAX:
+        _tts_cache.popitem(last=False)
+
+
+# Deleting the Devanagari block via str.translate lets the whole scan run
+# in C; counting per-char in Python is slow for long LLM outputs
+_DEVANAGARI_STRIP = str.maketrans({cp: None for cp in range(0x0900, 0x0980)})
+
 
 def _is_devanagari_script(text: str) -> bool:
     if not text:
         return False
-    devanagari_count = sum(1 for c in text if '\u0900' <= c <= '\u097F')
-    non_space = sum(1 for c in text if not c.isspace())
+    devanagari_count = len(text) - len(text.translate(_DEVANAGARI_STRIP))
+    non_space = len("".join(text.split()))
     return (devanagari_count / non_space) > 0.3 if non_space else False
 
 
+def _ascii_ratio(text: str) -> float:
+    # encode drops non-ASCII chars in C, leaving a pure ASCII count
+    return len(text.encode("ascii", "ignore")) / len(text)
+
+
 def _is_already_romanized(text: str) -> bool:
     if not text:
         return True
-    ascii_count = sum(1 for c in text if c.isascii())
-    return (ascii_count / len(text)) > 0.9
+    return _ascii_ratio(text) > 0.9
+
+
+async def warmup():
+    """Issue a 1-token generation at startup so the first real user
+    doesn't pay DNS + TLS + model cold-start. Failures are non-fatal."""
+    try:
+        await client.aio.models.generate_content(
+            model=MODEL_NAME,
+            contents="ok",
+            config=types.GenerateContentConfig(max_output_tokens=1),
+        )
+        logger.info("Gemini warmup complete")
+    except Exception as e:
+        logger.warning(f"Gemini warmup failed (non-fatal): {e}")
 
 
 def _parse_gemini_error(error: Exception) -> str:
@@ -80,51 +132,84 @@ def _parse_gemini_error(error: Exception) -> str:
         return "UNKNOWN_ERROR"
 
 
-async def _call_gemini_with_retry(contents: str, system_instruction: str, purpose: str) -> str:
+def _retry_after_hint(error: Exception):
+    """Pull a Retry-After value (seconds) out of a 429 response, if the
+    SDK surfaced one"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+async def _call_gemini_with_retry(contents: str, system_instruction: str, purpose: str,
+                                  config: types.GenerateContentConfig = None) -> str:
     """
     Call Gemini API with retry logic.
-    Retries 3 times with delays of 5s, 10s, 15s.
-    
+    Retries up to MAX_RETRIES times with decorrelated-jitter backoff,
+    honoring a Retry-After hint when the API sends one. A bad API key
+    fails immediately - retrying can't fix it.
+
     Args:
         contents: The user prompt
         system_instruction: System prompt for Gemini
         purpose: What this call is for (for logging)
-    
+        config: Optional full GenerateContentConfig (overrides system_instruction)
+
     Returns:
         Response text
-    
+
     Raises:
         Exception with clear error message if all retries fail
     """
     last_error = None
     last_error_type = None
-    
-    for attempt in range(len(RETRY_DELAYS) + 1):  # 4 attempts total (initial + 3 retries)
+    delay = BACKOFF_BASE
+
+    GEMINI_BREAKER.check()
+
+    if config is None:
+        config = types.GenerateContentConfig(system_instruction=system_instruction)
+
+    for attempt in range(MAX_RETRIES + 1):
         try:
             response = await client.aio.models.generate_content(
                 model=MODEL_NAME,
                 contents=contents,
-                config=types.GenerateContentConfig(system_instruction=system_instruction)
+                config=config
             )
-            
+
             if response.text and response.text.strip():
+                GEMINI_BREAKER.record_success()
                 return response.text.strip()
             else:
                 raise Exception("Empty response from Gemini")
-                
+
         except Exception as e:
             last_error = e
             last_error_type = _parse_gemini_error(e)
-            
-            if attempt < len(RETRY_DELAYS):
-                delay = RETRY_DELAYS[attempt]
-                log(f"           [{purpose}] Attempt {attempt + 1} failed: {last_error_type}")
-                log(f"           [{purpose}] Retrying in {delay}s...")
+
+            if last_error_type == "INVALID_API_KEY":
+                logger.error(f"[{purpose}] Invalid API key - not retrying")
+                GEMINI_BREAKER.record_failure()
+                break
+
+            if attempt < MAX_RETRIES:
+                delay = min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, delay * 3))
+                retry_after = _retry_after_hint(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                logger.info(f"[{purpose}] Attempt {attempt + 1} failed: {last_error_type}, retrying in {delay:.1f}s...")
                 await asyncio.sleep(delay)
             else:
                 # All retries exhausted
-                log(f"           [{purpose}] All {len(RETRY_DELAYS) + 1} attempts failed")
-    
+                logger.warning(f"[{purpose}] All {MAX_RETRIES + 1} attempts failed")
+                GEMINI_BREAKER.record_failure()
+
     # Generate clear error message
     if last_error_type == "API_LIMIT_EXCEEDED":
         error_msg = "Gemini API limit exceeded. Your daily quota may be exhausted. Try again later or upgrade your plan."
@@ -140,6 +225,171 @@ async def _call_gemini_with_retry(contents: str, system_instruction: str, purpos
     raise Exception(error_msg)
 
 
+def _advisor_system_prompt(language_code: str) -> str:
+    """Build the Agricultural Advisor system prompt for a language"""
+    lang_name = LANGUAGE_NAMES.get(language_code, "the user's language")
+
+    if language_code == "hi":
+        style_note = "Use casual Hinglish."
+    elif language_code in DEVANAGARI_SCRIPT_LANGS:
+        style_note = f"Respond naturally in {lang_name}."
+    else:
+        style_note = f"Use natural {lang_name}."
+
+    return f'''You are a female agricultural advisor for Indian farmers.
+Use feminine pronouns (main/mujhe) for yourself. Address the farmer as bhaiya/aap (male).
+Respond in {lang_name}. {style_note}
+Keep answers SHORT (2-3 sentences) for voice output.
+IMPORTANT: Do NOT put English translations in brackets. Just use ONE name for chemicals/pesticides - either the local name OR the English name, not both.'''
+
+
+@lru_cache(maxsize=32)
+def _advisor_config(language_code: str) -> types.GenerateContentConfig:
+    """Per-language advisor config, built once - the prompt is constant
+    per language so there's no point rebuilding it every request"""
+    return types.GenerateContentConfig(
+        system_instruction=_advisor_system_prompt(language_code)
+    )
+
+
+@lru_cache(maxsize=32)
+def _romanizer_config(language_code: str) -> types.GenerateContentConfig:
+    """Per-language TTS romanizer config, built once"""
+    lang_name = LANGUAGE_NAMES.get(language_code, language_code)
+    return types.GenerateContentConfig(
+        system_instruction=f'''Convert {lang_name} to romanized pronunciation.
+Do NOT translate. Write phonetically in English letters.
+SKIP any text inside parentheses or brackets - do not romanize it twice.
+Output ONLY the romanized text.'''
+    )
+
+
+# Sentence boundaries for cascaded streaming (includes Devanagari danda)
+_SENTENCE_END_RE = re.compile(r'(?<=[।.?!])\s+')
+
+
+async def stream_gemini_sentences(query: str, language_code: str = "hi") -> AsyncIterator[str]:
+    """
+    GEMINI 1 (streaming): Agricultural Advisor
+    Yield complete sentences as Gemini generates them, so TTS can start
+    on the first sentence while the rest of the answer is still coming.
+    """
+    start_time = time.time()
+
+    GEMINI_BREAKER.check()
+
+    # Establishing the stream is retried with the same jittered backoff
+    # as the non-streaming calls; once sentences have been yielded a
+    # retry would replay the answer, so mid-stream failures propagate
+    stream = None
+    delay = BACKOFF_BASE
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            stream = await client.aio.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=query,
+                config=_advisor_config(language_code)
+            )
+            break
+        except Exception as e:
+            error_type = _parse_gemini_error(e)
+            if error_type == "INVALID_API_KEY" or attempt >= MAX_RETRIES:
+                logger.warning(f"[Advisor stream] Giving up: {error_type}")
+                GEMINI_BREAKER.record_failure()
+                raise
+            delay = min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, delay * 3))
+            retry_after = _retry_after_hint(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            logger.info(f"[Advisor stream] Attempt {attempt + 1} failed: {error_type}, retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+    buffer = ""
+    try:
+        async for chunk in stream:
+            if not chunk.text:
+                continue
+            buffer += chunk.text
+            parts = _SENTENCE_END_RE.split(buffer)
+            buffer = parts.pop()  # keep the incomplete tail
+            for sentence in parts:
+                if sentence.strip():
+                    yield sentence.strip()
+    except Exception:
+        GEMINI_BREAKER.record_failure()
+        raise
+    if buffer.strip():
+        yield buffer.strip()
+
+    GEMINI_BREAKER.record_success()
+    elapsed = time.time() - start_time
+    logger.info(f"Gemini stream finished in {elapsed:.1f}s")
+
+
+async def get_gemini_response_with_tts(query: str, language_code: str = "hi") -> tuple:
+    """
+    GEMINI 1+2 combined: Agricultural Advisor + TTS Optimizer
+    One structured-output call returns both the answer and its TTS-ready
+    (romanized) form, saving a full Gemini round-trip on the
+    non-streaming path. Returns (answer, tts_text).
+
+    Only languages in NEEDS_ROMANIZATION_LANGS use the combined JSON
+    call; everything else gets a plain advisor call followed by the TTS
+    optimizer pass, which is a no-op for ASCII and Devanagari answers.
+    """
+    start_time = time.time()
+
+    if language_code not in NEEDS_ROMANIZATION_LANGS:
+        answer = await get_gemini_response(query, language_code)
+        # Languages outside the combined-call set may still need
+        # romanizing (e.g. Urdu's Perso-Arabic script); the optimizer
+        # no-ops cheaply for ASCII and Devanagari answers
+        tts_text = await make_pronounceable_for_tts(answer, language_code)
+        return answer, tts_text
+
+    system_prompt = _advisor_system_prompt(language_code) + '''
+
+Also return a "tts" field: the SAME answer written phonetically in English
+letters so a TTS engine can pronounce it. Do NOT translate - romanize.'''
+
+    config = types.GenerateContentConfig(
+        system_instruction=system_prompt,
+        response_mime_type="application/json",
+        response_schema={
+            "type": "object",
+            "properties": {
+                "answer": {"type": "string"},
+                "tts": {"type": "string"},
+            },
+            "required": ["answer", "tts"],
+        },
+    )
+
+    try:
+        raw = await _call_gemini_with_retry(
+            contents=query,
+            system_instruction=system_prompt,
+            purpose="Advisor+TTS",
+            config=config
+        )
+        data = orjson.loads(raw)
+        answer = (data.get("answer") or "").strip()
+        tts_text = (data.get("tts") or "").strip() or answer
+        if not answer:
+            raise Exception("Empty answer in Gemini JSON response")
+
+        elapsed = time.time() - start_time
+        logger.info(f"Gemini combined response received in {elapsed:.1f}s")
+        return answer, tts_text
+
+    except Exception as e:
+        # Fall back to the classic two-call path rather than failing
+        logger.warning(f"Combined Gemini call failed ({e}), falling back to two calls")
+        answer = await get_gemini_response(query, language_code)
+        tts_text = await make_pronounceable_for_tts(answer, language_code)
+        return answer, tts_text
+
+
 async def get_gemini_response(query: str, language_code: str = "hi") -> str:
     """
     GEMINI 1: Agricultural Advisor
@@ -147,37 +397,23 @@ async def get_gemini_response(query: str, language_code: str = "hi") -> str:
     Returns tuple: (response_text, time_taken_seconds)
     """
     start_time = time.time()
-    
+
     try:
-        lang_name = LANGUAGE_NAMES.get(language_code, "the user's language")
-        
-        if language_code == "hi":
-            style_note = "Use casual Hinglish."
-        elif language_code in DEVANAGARI_SCRIPT_LANGS:
-            style_note = f"Respond naturally in {lang_name}."
-        else:
-            style_note = f"Use natural {lang_name}."
-        
-        system_prompt = f'''You are a female agricultural advisor for Indian farmers.
-Use feminine pronouns (main/mujhe) for yourself. Address the farmer as bhaiya/aap (male).
-Respond in {lang_name}. {style_note}
-Keep answers SHORT (2-3 sentences) for voice output.
-IMPORTANT: Do NOT put English translations in brackets. Just use ONE name for chemicals/pesticides - either the local name OR the English name, not both.'''
-        
         result = await _call_gemini_with_retry(
             contents=query,
-            system_instruction=system_prompt,
-            purpose="Agricultural Advisor"
+            system_instruction=None,
+            purpose="Agricultural Advisor",
+            config=_advisor_config(language_code)
         )
         
         elapsed = time.time() - start_time
-        log(f"           Gemini response received in {elapsed:.1f}s")
+        logger.info(f"Gemini response received in {elapsed:.1f}s")
         
         return result
         
     except Exception as e:
         elapsed = time.time() - start_time
-        log(f"           [ERROR] Gemini failed after {elapsed:.1f}s: {e}")
+        logger.error(f"Gemini failed after {elapsed:.1f}s: {e}")
         raise
 
 
@@ -191,43 +427,56 @@ async def make_pronounceable_for_tts(text: str, language_code: str = "hi") -> st
     try:
         # Already ASCII?
         if _is_already_romanized(text):
-            log(f"           TTS: Already ASCII, no change needed (0.0s)")
+            logger.info(f"TTS: Already ASCII, no change needed (0.0s)")
             return text
         
         # Devanagari? ElevenLabs handles it
         if language_code in DEVANAGARI_SCRIPT_LANGS or _is_devanagari_script(text):
-            log(f"           TTS: Devanagari ({language_code}), ElevenLabs handles it (0.0s)")
+            logger.info(f"TTS: Devanagari ({language_code}), ElevenLabs handles it (0.0s)")
             return text
         
-        # Other scripts need romanization
-        log(f"           TTS: Romanizing {language_code} for TTS...")
-        
-        lang_name = LANGUAGE_NAMES.get(language_code, language_code)
-        
-        system_prompt = f'''Convert {lang_name} to romanized pronunciation.
-Do NOT translate. Write phonetically in English letters.
-SKIP any text inside parentheses or brackets - do not romanize it twice.
-Output ONLY the romanized text.'''
+        # Seen this exact text recently? Skip the Gemini call
+        cache_key = (language_code, hashlib.sha1(text.encode("utf-8")).hexdigest())
+        cached = _tts_cache_get(cache_key)
+        if cached is not None:
+            logger.info(f"TTS: Romanization cache hit (0.0s)")
+            return cached
+
+        # Table-driven local transliteration first: no API call, no quota
+        if sanscript is not None and language_code in _TRANSLIT_SCHEMES:
+            result = sanscript.transliterate(
+                text, _TRANSLIT_SCHEMES[language_code], sanscript.ITRANS
+            )
+            if result and _ascii_ratio(result) > 0.8:
+                logger.info(f"TTS: Transliterated {language_code} locally (0.0s)")
+                _tts_cache_put(cache_key, result)
+                return result
+
+        # Unsupported script (or mixed text the tables couldn't handle):
+        # fall back to the Gemini romanizer
+        logger.info(f"TTS: Romanizing {language_code} for TTS...")
 
         result = await _call_gemini_with_retry(
             contents=f"Romanize: {text}",
-            system_instruction=system_prompt,
-            purpose="TTS Romanizer"
+            system_instruction=None,
+            purpose="TTS Romanizer",
+            config=_romanizer_config(language_code)
         )
         
         elapsed = time.time() - start_time
         
         if len(result) > 0:
-            ascii_ratio = sum(1 for c in result if c.isascii()) / len(result)
+            ascii_ratio = _ascii_ratio(result)
             if ascii_ratio > 0.8:
-                log(f"           TTS: Romanization done ({ascii_ratio:.0%} ASCII) in {elapsed:.1f}s")
+                logger.info(f"TTS: Romanization done ({ascii_ratio:.0%} ASCII) in {elapsed:.1f}s")
+                _tts_cache_put(cache_key, result)
                 return result
         
-        log(f"           TTS: Romanization failed, using original ({elapsed:.1f}s)")
+        logger.info(f"TTS: Romanization failed, using original ({elapsed:.1f}s)")
         return text
         
     except Exception as e:
         elapsed = time.time() - start_time
-        log(f"           [ERROR] TTS Romanizer failed after {elapsed:.1f}s: {e}")
+        logger.error(f"TTS Romanizer failed after {elapsed:.1f}s: {e}")
         # Return original text on error - don't break the pipeline
         return text
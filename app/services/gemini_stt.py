@@ -2,41 +2,190 @@
 Gemini-based Speech-to-Text Service
 Uses Gemini's multimodal capabilities to transcribe audio.
 """
-from google import genai
 from google.genai import types
-import os
-import sys
+import aiofiles
+import hashlib
+import logging
+import random
+import re
+import shutil
+import struct
 import time
 import asyncio
-from datetime import datetime
 from pathlib import Path
-from dotenv import load_dotenv
+from types import MappingProxyType
 
-load_dotenv()
+from app.config import TEMP_DIR, gemini_stt_client as client
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.response_cache import TTLCache
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
+logger = logging.getLogger(__name__)
 
-def log(message: str):
-    """Print to terminal AND save to log file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted = f"[{timestamp}] {message}"
-    print(formatted, file=sys.stderr, flush=True)
-    sys.stderr.flush()
-    log_file = os.path.join(LOGS_DIR, f"bot_{datetime.now().strftime('%Y%m%d')}.log")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(formatted + "\n")
+# Transcriptions keyed by audio content hash: webhook re-deliveries and
+# UI retries re-send byte-identical files, so skip the whole API call
+_transcription_cache = TTLCache(max_entries=512, ttl=3600)
+_transcription_cache_lock = asyncio.Lock()
 
-if not GOOGLE_API_KEY:
-    log("[WARNING] GOOGLE_API_KEY not found - Gemini STT won't work")
-
-# Gemini client
-client = genai.Client(api_key=GOOGLE_API_KEY)
 MODEL_NAME = "gemini-2.5-flash"
 
-# Retry delays
-RETRY_DELAYS = [5, 10, 15]
+STT_BREAKER = CircuitBreaker("Gemini STT")
+
+
+def _silent_wav(duration_s: float = 0.1, rate: int = 16000) -> bytes:
+    """Build a tiny silent 16-bit mono PCM WAV in memory (for warmup)"""
+    data = b"\x00\x00" * int(duration_s * rate)
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + len(data), b"WAVE",
+        b"fmt ", 16, 1, 1, rate, rate * 2, 2, 16,
+        b"data", len(data),
+    )
+    return header + data
+
+
+async def warmup():
+    """Send a 100 ms silent clip at startup so the STT client's TLS
+    session and the server-side multimodal route are primed before the
+    first real voice note. Failures are non-fatal."""
+    try:
+        await client.aio.models.generate_content(
+            model=MODEL_NAME,
+            contents=[
+                types.Part.from_bytes(data=_silent_wav(), mime_type="audio/wav"),
+                "Transcribe this audio.",
+            ],
+            config=types.GenerateContentConfig(max_output_tokens=1),
+        )
+        logger.info("Gemini STT warmup complete")
+    except Exception as e:
+        logger.warning(f"Gemini STT warmup failed (non-fatal): {e}")
+
+FFMPEG = shutil.which("ffmpeg")
+
+
+async def _compress_for_upload(audio_path: Path) -> Path:
+    """Trim leading/trailing silence and downsample to 16 kHz mono Opus
+    before shipping to Gemini. 3-5x fewer bytes on the wire and shorter
+    audio for the model; no-op when ffmpeg is unavailable.
+
+    Output files are named by a hash of the input bytes, so re-delivered
+    identical audio skips the ffmpeg subprocess entirely (the hourly
+    cache sweep evicts stale ones)."""
+    if not FFMPEG:
+        return audio_path
+
+    async with aiofiles.open(audio_path, "rb") as f:
+        raw = await f.read()
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    compressed = TEMP_DIR / f"stt_pre_{digest}.ogg"
+    try:
+        if compressed.stat().st_size > 0:
+            logger.info("Gemini STT: Reusing cached preprocessed audio")
+            return compressed
+    except FileNotFoundError:
+        pass
+
+    # Transcode to a temp name, then rename: a concurrent request for the
+    # same content never sees a half-written cache entry
+    tmp = compressed.with_suffix(".ogg.tmp")
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG, "-y", "-i", str(audio_path),
+        "-af", "silenceremove=1:0:-40dB:1:1:-40dB",
+        "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k",
+        "-f", "ogg", str(tmp),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    await proc.wait()
+
+    if proc.returncode == 0 and tmp.exists() and tmp.stat().st_size > 0:
+        tmp.replace(compressed)
+        logger.info(f"Gemini STT: Compressed {len(raw)} -> {compressed.stat().st_size} bytes")
+        return compressed
+
+    logger.warning("Gemini STT: ffmpeg compression failed, using original")
+    return audio_path
+
+# Decorrelated-jitter backoff (mirrors gemini_llm): quota errors get a
+# longer cap than transient overload/unknown failures since 429s rarely
+# clear in seconds
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAPS = {"API_LIMIT": 20.0, "OVERLOADED": 8.0, "ERROR": 8.0}
+
+
+def _retry_after_hint(error: Exception):
+    """Pull a Retry-After value (seconds) out of a 429 response, if the
+    SDK surfaced one"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+# Read-only MIME map - one dict lookup per request, never rebuilt
+_MIME_TYPES = MappingProxyType({
+    ".ogg": "audio/ogg", ".mp3": "audio/mpeg",
+    ".wav": "audio/wav", ".m4a": "audio/mp4", ".webm": "audio/webm",
+})
+
+_SYSTEM_INSTRUCTION = """You are an expert audio transcriber for Indian languages.
+
+Your task:
+1. Listen to the audio carefully
+2. Transcribe EXACTLY what is spoken
+3. Detect the language AND dialect
+
+Output format:
+LANGUAGE: [language name]
+TEXT: [transcribed text]
+
+Rules:
+- Transcribe in the ORIGINAL script
+- Do NOT translate to English
+- For Hindi/Hinglish, keep English words as-is
+- IMPORTANT: Distinguish between Hindi, Urdu, and Punjabi carefully:
+  * Hindi: Uses Devanagari script, common in North India
+  * Urdu: Uses Arabic/Persian-style vocabulary, more formal
+  * Punjabi: Distinct Punjabi vocabulary and accent
+- Preserve the exact dialect spoken (e.g., Bhojpuri vs Hindi, Haryanvi vs Hindi)"""
+
+# Explicit Gemini prefix cache for the system prompt: the server reuses
+# the cached KV state so only the audio part is processed per request.
+# Created lazily; short prompts can be rejected as below the minimum
+# cacheable token count, in which case we keep sending the prompt inline.
+_prompt_cache_name = None
+_prompt_cache_failed = False
+
+
+async def _transcribe_config() -> types.GenerateContentConfig:
+    global _prompt_cache_name, _prompt_cache_failed
+    if _prompt_cache_name is None and not _prompt_cache_failed:
+        try:
+            cache = await client.aio.caches.create(
+                model=MODEL_NAME,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=_SYSTEM_INSTRUCTION, ttl="3600s"
+                ),
+            )
+            _prompt_cache_name = cache.name
+            logger.info("Gemini STT: System prompt cached server-side")
+        except Exception as e:
+            logger.info(f"Gemini STT: Prompt cache unavailable ({e}), sending inline")
+            _prompt_cache_failed = True
+    if _prompt_cache_name:
+        return types.GenerateContentConfig(cached_content=_prompt_cache_name)
+    return types.GenerateContentConfig(system_instruction=_SYSTEM_INSTRUCTION)
+
+
+def _reset_prompt_cache():
+    """Drop a stale cache handle (expired TTL) so the next call recreates it"""
+    global _prompt_cache_name
+    _prompt_cache_name = None
 
 # Language code mapping
 LANGUAGE_CODE_MAP = {
@@ -47,9 +196,20 @@ LANGUAGE_CODE_MAP = {
 }
 
 
+# Response layout: a LANGUAGE line followed (possibly after blank lines)
+# by everything else as the transcription
+_PARSE_RE = re.compile(r"LANGUAGE:\s*(?P<lang>[^\n]+).*?TEXT:\s*(?P<text>.+)", re.S)
+
+
 def _parse_language_code(lang_text: str) -> str:
     """Convert language name to code"""
     lang_lower = lang_text.lower().strip()
+    # Fast path: the model almost always answers with a bare language name
+    first_word = lang_lower.split(" ", 1)[0]
+    code = LANGUAGE_CODE_MAP.get(first_word)
+    if code:
+        return code
+    # Fallback: name buried in extra prose ("Hindi (Haryanvi dialect)")
     for name, code in LANGUAGE_CODE_MAP.items():
         if name in lang_lower:
             return code
@@ -68,76 +228,69 @@ async def transcribe_audio_gemini(audio_path: str) -> dict:
     """
     start_time = time.time()
     last_error = None
-    
-    for attempt in range(len(RETRY_DELAYS) + 1):
-        try:
-            audio_path = Path(audio_path)
-            if not audio_path.exists():
-                raise Exception(f"Audio file not found: {audio_path}")
-            
-            # Determine MIME type
-            suffix = audio_path.suffix.lower()
-            mime_types = {
-                ".ogg": "audio/ogg", ".mp3": "audio/mpeg",
-                ".wav": "audio/wav", ".m4a": "audio/mp4", ".webm": "audio/webm",
-            }
-            mime_type = mime_types.get(suffix, "audio/ogg")
-            
-            # Read audio data
-            with open(audio_path, "rb") as f:
-                audio_data = f.read()
-            
-            audio_part = types.Part.from_bytes(data=audio_data, mime_type=mime_type)
-            
-            system_instruction = """You are an expert audio transcriber for Indian languages.
 
-Your task:
-1. Listen to the audio carefully
-2. Transcribe EXACTLY what is spoken
-3. Detect the language AND dialect
+    STT_BREAKER.check()
 
-Output format:
-LANGUAGE: [language name]
-TEXT: [transcribed text]
+    audio_path = Path(audio_path)
+    if not audio_path.exists():
+        raise Exception(f"Audio file not found: {audio_path}")
+    audio_path = await _compress_for_upload(audio_path)
 
-Rules:
-- Transcribe in the ORIGINAL script
-- Do NOT translate to English
-- For Hindi/Hinglish, keep English words as-is
-- IMPORTANT: Distinguish between Hindi, Urdu, and Punjabi carefully:
-  * Hindi: Uses Devanagari script, common in North India
-  * Urdu: Uses Arabic/Persian-style vocabulary, more formal
-  * Punjabi: Distinct Punjabi vocabulary and accent
-- Preserve the exact dialect spoken (e.g., Bhojpuri vs Hindi, Haryanvi vs Hindi)"""
+    # Read once, build the request part once - retries reuse both, and the
+    # async read keeps the event loop free during disk I/O
+    mime_type = _MIME_TYPES.get(audio_path.suffix.lower(), "audio/ogg")
+    async with aiofiles.open(audio_path, "rb") as f:
+        audio_data = await f.read()
+
+    # Byte-identical audio (webhook re-delivery, client retry) reuses the
+    # previous transcription without another round-trip
+    digest = hashlib.blake2b(audio_data, digest_size=16).hexdigest()
+    async with _transcription_cache_lock:
+        cached = _transcription_cache.get(digest)
+    if cached is not None:
+        logger.info("Gemini STT: Transcription cache hit")
+        return dict(cached)
+
+    audio_part = types.Part.from_bytes(data=audio_data, mime_type=mime_type)
 
+    delay = BACKOFF_BASE
+    for attempt in range(MAX_RETRIES + 1):
+        try:
             response = await client.aio.models.generate_content(
                 model=MODEL_NAME,
                 contents=[audio_part, "Transcribe this audio."],
-                config=types.GenerateContentConfig(system_instruction=system_instruction)
+                config=await _transcribe_config()
             )
             
             result_text = response.text.strip()
             
-            # Parse response
+            # Parse response with one precompiled scan instead of
+            # splitting into lines
             language_code = "hi"
             transcription = result_text
-            
-            if "LANGUAGE:" in result_text and "TEXT:" in result_text:
-                for line in result_text.split("\n"):
-                    if line.startswith("LANGUAGE:"):
-                        language_code = _parse_language_code(line.replace("LANGUAGE:", ""))
-                    elif line.startswith("TEXT:"):
-                        transcription = line.replace("TEXT:", "").strip()
+
+            m = _PARSE_RE.search(result_text)
+            if m:
+                language_code = _parse_language_code(m["lang"])
+                transcription = m["text"].strip()
             
             elapsed = time.time() - start_time
-            log(f"           Gemini STT: Transcribed in {elapsed:.1f}s (lang: {language_code})")
-            
-            return {"text": transcription, "language": language_code}
+            logger.info(f"Gemini STT: Transcribed in {elapsed:.1f}s (lang: {language_code})")
+
+            STT_BREAKER.record_success()
+            result = {"text": transcription, "language": language_code}
+            async with _transcription_cache_lock:
+                _transcription_cache.put(digest, result)
+            return dict(result)
             
         except Exception as e:
             last_error = e
             error_str = str(e).lower()
-            
+
+            # Stale/expired prompt cache: recreate on the next attempt
+            if _prompt_cache_name and "cachedcontent" in error_str:
+                _reset_prompt_cache()
+
             if "429" in str(e) or "quota" in error_str:
                 error_type = "API_LIMIT"
             elif "503" in str(e) or "overloaded" in error_str:
@@ -145,13 +298,18 @@ Rules:
             else:
                 error_type = "ERROR"
             
-            if attempt < len(RETRY_DELAYS):
-                delay = RETRY_DELAYS[attempt]
-                log(f"           Gemini STT: Attempt {attempt + 1} failed ({error_type}), retry in {delay}s...")
+            if attempt < MAX_RETRIES:
+                cap = BACKOFF_CAPS.get(error_type, BACKOFF_CAPS["ERROR"])
+                delay = min(cap, random.uniform(BACKOFF_BASE, delay * 3))
+                retry_after = _retry_after_hint(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                logger.info(f"Gemini STT: Attempt {attempt + 1} failed ({error_type}), retry in {delay:.1f}s...")
                 await asyncio.sleep(delay)
             else:
-                log(f"           Gemini STT: All attempts failed ({error_type})")
-    
+                logger.warning(f"Gemini STT: All attempts failed ({error_type})")
+                STT_BREAKER.record_failure()
+
     elapsed = time.time() - start_time
     error_msg = str(last_error)
     
@@ -0,0 +1,68 @@
+"""
+In-memory reply cache for the voice pipeline.
+Repeat farmer queries (same wording after normalization) reuse the
+previously generated answer and MP3 instead of re-running LLM + TTS.
+"""
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class TTLCache:
+    """Small LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries: int = 512, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, added = entry
+        if time.time() - added > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (value, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_PUNCT_RE = re.compile(r"[?!.,،।]+")
+
+# Keyed by (language, normalized transcription)
+_reply_cache = TTLCache(max_entries=256, ttl=3600)
+
+
+def normalize_query(text: str) -> str:
+    """Collapse punctuation/whitespace/case so trivial rephrasings match"""
+    return _WHITESPACE_RE.sub(" ", _PUNCT_RE.sub(" ", text.lower())).strip()
+
+
+def get_cached_reply(transcription: str, language: str):
+    """Return {"response", "tts_text", "audio_path"} or None on miss.
+    Entries whose MP3 was evicted from disk are treated as misses."""
+    entry = _reply_cache.get((language, normalize_query(transcription)))
+    if entry is None:
+        return None
+    if not Path(entry["audio_path"]).exists():
+        return None
+    return entry
+
+
+def cache_reply(transcription: str, language: str, response: str,
+                tts_text: str, audio_path: str):
+    """Record a finished pipeline run for reuse"""
+    _reply_cache.put((language, normalize_query(transcription)), {
+        "response": response,
+        "tts_text": tts_text,
+        "audio_path": audio_path,
+    })